@@ -0,0 +1,24 @@
+import os
+
+# Rate limiting (token bucket per client and route)
+# Default bucket applied to every route: RATE sustained requests/second, BURST max
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_DEFAULT_RATE = float(os.getenv("RATE_LIMIT_DEFAULT_RATE", "10"))
+RATE_LIMIT_DEFAULT_BURST = int(os.getenv("RATE_LIMIT_DEFAULT_BURST", "20"))
+
+# GET /cards returns the whole table, so it gets a tighter bucket
+RATE_LIMIT_LIST_CARDS_RATE = float(os.getenv("RATE_LIMIT_LIST_CARDS_RATE", "2"))
+RATE_LIMIT_LIST_CARDS_BURST = int(os.getenv("RATE_LIMIT_LIST_CARDS_BURST", "5"))
+
+# Login runs bcrypt, keep it slow for a single client
+RATE_LIMIT_LOGIN_RATE = float(os.getenv("RATE_LIMIT_LOGIN_RATE", "0.2"))
+RATE_LIMIT_LOGIN_BURST = int(os.getenv("RATE_LIMIT_LOGIN_BURST", "5"))
+
+# Max requests in flight across all clients for expensive endpoints
+CONCURRENCY_LIMIT_LIST_CARDS = int(os.getenv("CONCURRENCY_LIMIT_LIST_CARDS", "4"))
+CONCURRENCY_LIMIT_LOGIN = int(os.getenv("CONCURRENCY_LIMIT_LOGIN", "4"))
+CONCURRENCY_LIMIT_DUPLICATES = int(os.getenv("CONCURRENCY_LIMIT_DUPLICATES", "2"))
+
+# Optional shared backend so limits hold across several API processes
+# e.g. redis://localhost:6379/0 (requires the `redis` package)
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
@@ -1,14 +1,18 @@
-from fastapi import FastAPI, HTTPException, Depends, File, UploadFile
+from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, Request, Query
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from app.schemas import Card, CardResponse
-from sqlalchemy.orm import Session
-from app.database import get_db, engine
+from app.schemas import Card, CardResponse, CardOwner, CardWithOwnerResponse, CardCreateResponse, DuplicateMatch, DuplicatePair, DuplicateReport
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.exc import IntegrityError
+from app.database import get_db, get_read_db, mark_write, engine
 from app.models.card import Card as DBCard, Base
-from app.schemas.user import UserCreate, UserResponse
+from app.schemas.user import UserCreate, UserResponse, UserWithCardsResponse
 from app.models.user import User
 from app.auth.auth import create_user, get_user_by_email, verify_password
-from typing import List
+from app.utils import duplicates
+from app.utils.rate_limit import rate_limit, concurrency_limit, default_rate_limit
+from app import config
+from typing import List, Optional
 import shutil
 import os
 from uuid import uuid4
@@ -25,7 +29,7 @@ try:
 except Exception as e:
     logger.error(f"Error creating database tables: {e}")
 
-app = FastAPI()
+app = FastAPI(dependencies=[Depends(default_rate_limit)])
 
 app.add_middleware(
     CORSMiddleware,
@@ -46,14 +50,25 @@ def read_root():
 def health_check():
     return {"status": "healthy"}
 
-@app.post("/cards", response_model=CardResponse)
-def createCard(card: Card, db: Session = Depends(get_db)):
+def is_foreign_key_violation(error: IntegrityError) -> bool:
+    """True for a foreign key violation on PostgreSQL (SQLSTATE 23503) or SQLite"""
+    return (
+        getattr(error.orig, "pgcode", None) == "23503"
+        or "FOREIGN KEY constraint failed" in str(error.orig)
+    )
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.error(f"Error removing {path}: {e}")
+
+@app.post("/cards", response_model=CardCreateResponse)
+def createCard(card: Card, request: Request, db: Session = Depends(get_db)):
+    # Images written to disk for this card, removed again if the insert fails
+    saved_files = []
     try:
-        # First, validate that the user exists
-        user = db.query(User).filter(User.id == card.user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail=f"User with id {card.user_id} not found")
-        
         # Handle image URLs - if they're base64 data URLs, save them as files
         front_image_url = card.front_image_url
         back_image_url = card.back_image_url
@@ -78,6 +93,7 @@ def createCard(card: Card, db: Session = Depends(get_db)):
             # Save the file
             with open(filepath, "wb") as f:
                 f.write(image_data)
+            saved_files.append(filepath)
             
             front_image_url = f"/static/images/{filename}"
         
@@ -101,6 +117,7 @@ def createCard(card: Card, db: Session = Depends(get_db)):
             # Save the file
             with open(filepath, "wb") as f:
                 f.write(image_data)
+            saved_files.append(filepath)
             
             back_image_url = f"/static/images/{filename}"
         
@@ -111,45 +128,110 @@ def createCard(card: Card, db: Session = Depends(get_db)):
         
         db_card = DBCard(**card_data)
         db.add(db_card)
+        # The user_id foreign key rejects unknown users, no separate lookup needed
         db.commit()
         db.refresh(db_card)
-        logger.info(f"Card created successfully for user {card.user_id}")
-        return db_card
+    except IntegrityError as e:
+        db.rollback()
+        remove_files(saved_files)
+        logger.error(f"Error creating card: {e}")
+        if is_foreign_key_violation(e):
+            raise HTTPException(status_code=404, detail=f"User with id {card.user_id} not found")
+        raise HTTPException(status_code=400, detail=f"Error creating card: {str(e)}")
     except Exception as e:
         db.rollback()
+        remove_files(saved_files)
         logger.error(f"Error creating card: {e}")
         raise HTTPException(status_code=400, detail=f"Error creating card: {str(e)}")
+    
+    # The card is stored from here on, nothing below may turn this into an error
+    mark_write(request, card.user_id)
+    logger.info(f"Card created successfully for user {card.user_id}")
+    response = CardCreateResponse.model_validate(db_card, from_attributes=True)
+    try:
+        duplicates.card_added(card.user_id, db_card)
+        possible_duplicates = duplicates.find_duplicates(db, card.user_id, db_card, exclude_id=db_card.id)
+        response.possible_duplicates = [
+            DuplicateMatch(card_id=card_id, score=score, exact=exact)
+            for card_id, score, exact in possible_duplicates
+        ]
+    except Exception as e:
+        logger.error(f"Error checking card {db_card.id} for duplicates: {e}")
+    if response.possible_duplicates:
+        logger.info(f"Card {db_card.id} has {len(response.possible_duplicates)} possible duplicates")
+    return response
 
 
-@app.get("/cards", response_model=List[CardResponse])  # Fixed this line
-def getCards(db: Session = Depends(get_db)):
-    cards = db.query(DBCard).all()
-    return cards
+def parse_include(include: Optional[str], allowed: set) -> set:
+    """Parse a comma separated ?include= value, rejecting unknown relations"""
+    if not include:
+        return set()
+    requested = {part.strip() for part in include.split(",") if part.strip()}
+    unknown = requested - allowed
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown include: {', '.join(sorted(unknown))}. Allowed: {', '.join(sorted(allowed))}",
+        )
+    return requested
 
-@app.get("/cards/{card_id}", response_model=CardResponse)
-def getCard(card_id: int, db: Session = Depends(get_db)):
-    card = db.query(DBCard).filter(DBCard.id == card_id).first()
+def card_responses(cards, include_owner: bool) -> List[CardWithOwnerResponse]:
+    """Build card responses, only touching card.user when the owner was eager loaded"""
+    responses = []
+    for card in cards:
+        response = CardWithOwnerResponse.model_validate(card, from_attributes=True)
+        if include_owner and card.user is not None:
+            response.owner = CardOwner.model_validate(card.user, from_attributes=True)
+        responses.append(response)
+    return responses
+
+@app.get(
+    "/cards",
+    response_model=List[CardWithOwnerResponse],
+    dependencies=[
+        Depends(rate_limit(config.RATE_LIMIT_LIST_CARDS_RATE, config.RATE_LIMIT_LIST_CARDS_BURST, "list_cards")),
+        Depends(concurrency_limit(config.CONCURRENCY_LIMIT_LIST_CARDS)),
+    ],
+)
+def getCards(include: Optional[str] = None, db: Session = Depends(get_read_db)):
+    include_owner = "owner" in parse_include(include, {"owner"})
+    query = db.query(DBCard)
+    if include_owner:
+        # Owners come back in the same statement instead of one query per card
+        query = query.options(joinedload(DBCard.user))
+    return card_responses(query.all(), include_owner)
+
+@app.get("/cards/{card_id}", response_model=CardWithOwnerResponse)
+def getCard(card_id: int, include: Optional[str] = None, db: Session = Depends(get_read_db)):
+    include_owner = "owner" in parse_include(include, {"owner"})
+    query = db.query(DBCard).filter(DBCard.id == card_id)
+    if include_owner:
+        query = query.options(joinedload(DBCard.user))
+    card = query.first()
     if not card:
         raise HTTPException(status_code=404, detail="Card not found")
-    return card
+    return card_responses([card], include_owner)[0]
 
 @app.delete("/cards/{card_id}")
-def deleteCard(card_id: int, db: Session = Depends(get_db)):
+def deleteCard(card_id: int, request: Request, db: Session = Depends(get_db)):
     card = db.query(DBCard).filter(DBCard.id == card_id).first()
     if not card:
         raise HTTPException(status_code=404, detail="Card not found")
     
     db.delete(card)
     db.commit()
+    mark_write(request, card.user_id)
+    duplicates.card_removed(card.user_id, card_id)
     return {"message": f"Card {card_id} deleted successfully"}
 
 @app.put("/cards/{card_id}", response_model=CardResponse)
-def updateCard(card_id: int, card: Card, db: Session = Depends(get_db)):
+def updateCard(card_id: int, card: Card, request: Request, db: Session = Depends(get_db)):
     try:
         # Find the existing card
         db_card = db.query(DBCard).filter(DBCard.id == card_id).first()
         if not db_card:
             raise HTTPException(status_code=404, detail="Card not found")
+        previous_user_id = db_card.user_id
         
         # Handle image URLs - if they're base64 data URLs, save them as files
         front_image_url = card.front_image_url
@@ -212,6 +294,8 @@ def updateCard(card_id: int, card: Card, db: Session = Depends(get_db)):
         
         db.commit()
         db.refresh(db_card)
+        mark_write(request, db_card.user_id)
+        duplicates.card_updated(previous_user_id, db_card)
         logger.info(f"Card {card_id} updated successfully")
         return db_card
     except Exception as e:
@@ -220,14 +304,22 @@ def updateCard(card_id: int, card: Card, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail=f"Error updating card: {str(e)}")
 
 @app.post("/users/register", response_model=UserResponse)
-def register_user(user: UserCreate, db: Session = Depends(get_db)):
+def register_user(user: UserCreate, request: Request, db: Session = Depends(get_db)):
     db_user = get_user_by_email(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    return create_user(db=db, user=user)
+    db_user = create_user(db=db, user=user)
+    mark_write(request, db_user.id)
+    return db_user
 
-@app.post("/users/login")
+@app.post(
+    "/users/login",
+    dependencies=[
+        Depends(rate_limit(config.RATE_LIMIT_LOGIN_RATE, config.RATE_LIMIT_LOGIN_BURST, "login")),
+        Depends(concurrency_limit(config.CONCURRENCY_LIMIT_LOGIN)),
+    ],
+)
 def login_user(data: dict, db: Session = Depends(get_db)):
     username = data.get("username")
     password = data.get("password")
@@ -238,15 +330,53 @@ def login_user(data: dict, db: Session = Depends(get_db)):
         raise HTTPException(status_code=401, detail="Invalid username or password")
     return {"id": user.id, "username": user.username, "email": user.email}
 
-@app.get("/users/{user_id}", response_model=UserResponse)
-def get_user(user_id: int, db: Session = Depends(get_db)):
+@app.get("/users/{user_id}", response_model=UserWithCardsResponse)
+def get_user(
+    user_id: int,
+    include: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    db: Session = Depends(get_read_db),
+):
+    include_cards = "cards" in parse_include(include, {"cards"})
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Validate as UserResponse: with from_attributes the `cards` field would read
+    # User.cards and lazy load the whole collection
+    response = UserWithCardsResponse(**UserResponse.model_validate(user, from_attributes=True).model_dump())
+    if include_cards:
+        # One query for the cards, limited in the database rather than loading User.cards
+        cards_query = db.query(DBCard).filter(DBCard.user_id == user_id).order_by(DBCard.id)
+        if limit is not None:
+            cards_query = cards_query.limit(limit)
+        response.cards = [CardResponse.model_validate(card, from_attributes=True) for card in cards_query.all()]
+    return response
+
+@app.get(
+    "/users/{user_id}/cards/duplicates",
+    response_model=DuplicateReport,
+    dependencies=[Depends(concurrency_limit(config.CONCURRENCY_LIMIT_DUPLICATES))],
+)
+def get_duplicate_cards(user_id: int, db: Session = Depends(get_db)):
+    # Primary on purpose: the duplicate index built here is cached, a lagging
+    # replica snapshot would stick around
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    
+    total_cards, pairs = duplicates.duplicate_report(db, user_id)
+    return DuplicateReport(
+        user_id=user_id,
+        total_cards=total_cards,
+        pairs=[
+            DuplicatePair(card_ids=[card_a, card_b], score=score, exact=exact)
+            for card_a, card_b, score, exact in pairs
+        ],
+    )
 
 @app.delete("/users/{user_id}")
-def delete_user(user_id: int, db: Session = Depends(get_db)):
+def delete_user(user_id: int, request: Request, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -259,6 +389,8 @@ def delete_user(user_id: int, db: Session = Depends(get_db)):
     # Then delete the user
     db.delete(user)
     db.commit()
+    mark_write(request, user_id)
+    duplicates.invalidate(user_id)
     
     return {"message": f"User {user_id} and {len(user_cards)} associated cards deleted successfully"}
 
@@ -266,6 +398,7 @@ def delete_user(user_id: int, db: Session = Depends(get_db)):
 def upload_card_image(
     card_id: int,
     image_type: str,  # "front" or "back"
+    request: Request,
     file: UploadFile = File(...),
     db: Session = Depends(get_db)
 ):
@@ -295,5 +428,6 @@ def upload_card_image(
         card.back_image_url = image_url
     
     db.commit()
+    mark_write(request, card.user_id)
     
     return {"message": f"{image_type} image uploaded successfully", "image_url": image_url}
\ No newline at end of file
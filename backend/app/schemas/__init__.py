@@ -1 +1 @@
-from .card import Card, CardResponse
\ No newline at end of file
+from .card import Card, CardResponse, CardOwner, CardWithOwnerResponse, CardCreateResponse, DuplicateMatch, DuplicatePair, DuplicateReport
\ No newline at end of file
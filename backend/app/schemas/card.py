@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from datetime import datetime
 
 class Card(BaseModel):
@@ -32,4 +32,30 @@ class CardResponse(BaseModel):
     sold: bool = False
     front_image_url: Optional[str] = None
     back_image_url: Optional[str] = None
-    createdAt: datetime
\ No newline at end of file
+    createdAt: datetime
+
+class CardOwner(BaseModel):
+    id: int
+    username: str
+    email: str
+
+class CardWithOwnerResponse(CardResponse):
+    owner: Optional[CardOwner] = None
+
+class DuplicateMatch(BaseModel):
+    card_id: int
+    score: float
+    exact: bool
+
+class CardCreateResponse(CardResponse):
+    possible_duplicates: List[DuplicateMatch] = []
+
+class DuplicatePair(BaseModel):
+    card_ids: List[int]
+    score: float
+    exact: bool
+
+class DuplicateReport(BaseModel):
+    user_id: int
+    total_cards: int
+    pairs: List[DuplicatePair]
\ No newline at end of file
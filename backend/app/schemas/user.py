@@ -1,5 +1,7 @@
 from pydantic import BaseModel
 from datetime import datetime
+from typing import List, Optional
+from .card import CardResponse
 
 class UserCreate(BaseModel):
     email: str
@@ -10,4 +12,7 @@ class UserResponse(BaseModel):
     id: int
     email: str
     username :str
-    createdAt: datetime
\ No newline at end of file
+    createdAt: datetime
+
+class UserWithCardsResponse(UserResponse):
+    cards: Optional[List[CardResponse]] = None
\ No newline at end of file
@@ -0,0 +1,311 @@
+"""
+Duplicate card detection: normalized exact keys plus fuzzy matching with n-gram blocking
+"""
+
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from difflib import SequenceMatcher
+
+from sqlalchemy import func
+
+from app import database
+from app.models.card import Card as DBCard
+
+logger = logging.getLogger(__name__)
+
+# How much each field counts towards the similarity score
+FIELD_WEIGHTS = {
+    "playerName": 0.4,
+    "setName": 0.25,
+    "cardNumber": 0.2,
+    "brand": 0.15,
+}
+
+# Identifiers where "7" vs "77" is a different card, not a typo: all or nothing
+EXACT_FIELDS = {"cardNumber"}
+
+# Cards scoring at or above this are reported as possible duplicates
+SIMILARITY_THRESHOLD = 0.85
+
+# A candidate must share this fraction of the player name n-grams to be scored
+MIN_SHARED_NGRAMS = 0.5
+
+
+def normalize(value) -> str:
+    """Lowercase, strip accents and punctuation, collapse whitespace"""
+    if value is None:
+        return ""
+    text = unicodedata.normalize("NFKD", str(value))
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    text = re.sub(r"[^a-z0-9]+", " ", text)
+    return " ".join(text.split())
+
+
+def normalize_card_number(value) -> str:
+    """'#007', 'No. 7' and '7' all become '7'"""
+    text = normalize(value).replace(" ", "")
+    text = re.sub(r"^(no|num|number)(?=\d)", "", text)
+    return text.lstrip("0") or text
+
+
+def ngrams(text: str, n: int = 3) -> set:
+    padded = f" {text} "
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+class DuplicateIndex:
+    """
+    Index over one collection. Exact duplicates are found through a normalized key,
+    near-duplicates by only scoring cards with the same year and card number that
+    share enough player name n-grams, so no full pairwise comparison is needed.
+    A different card number can never reach the threshold (see EXACT_FIELDS), so
+    it is part of the block key rather than checked after scoring.
+    """
+
+    def __init__(self, n: int = 3, threshold: float = SIMILARITY_THRESHOLD):
+        self.n = n
+        self.threshold = threshold
+        self._cards = {}
+        self._exact = {}
+        self._blocks = {}
+
+    def __len__(self):
+        return len(self._cards)
+
+    def __contains__(self, card_id):
+        return card_id in self._cards
+
+    def version(self) -> tuple:
+        """(card count, max card id), comparable with the database's"""
+        return (len(self._cards), max(self._cards, default=None))
+
+    def _fields(self, card) -> dict:
+        return {
+            "playerName": normalize(card.playerName),
+            "year": card.year,
+            "brand": normalize(card.brand),
+            "setName": normalize(card.setName),
+            "cardNumber": normalize_card_number(card.cardNumber),
+        }
+
+    def _exact_key(self, fields: dict) -> tuple:
+        return (fields["playerName"], fields["year"], fields["brand"], fields["setName"], fields["cardNumber"])
+
+    def _block_keys(self, fields: dict) -> set:
+        prefix = f"{fields['year']}:{fields['cardNumber']}"
+        return {f"{prefix}:{gram}" for gram in ngrams(fields["playerName"], self.n)}
+
+    def add(self, card_id: int, card):
+        """Add a card (ORM row, query row or schema with the card fields)"""
+        if card_id in self._cards:
+            self.remove(card_id)
+        fields = self._fields(card)
+        self._cards[card_id] = fields
+        self._exact.setdefault(self._exact_key(fields), set()).add(card_id)
+        for key in self._block_keys(fields):
+            self._blocks.setdefault(key, set()).add(card_id)
+
+    def remove(self, card_id: int):
+        fields = self._cards.pop(card_id, None)
+        if fields is None:
+            return
+        self._exact.get(self._exact_key(fields), set()).discard(card_id)
+        for key in self._block_keys(fields):
+            self._blocks.get(key, set()).discard(card_id)
+
+    def _score(self, a: dict, b: dict) -> float:
+        score = 0.0
+        for field, weight in FIELD_WEIGHTS.items():
+            if a[field] == b[field]:
+                score += weight
+            elif field in EXACT_FIELDS:
+                continue
+            elif a[field] and b[field]:
+                score += weight * SequenceMatcher(None, a[field], b[field]).ratio()
+        return score
+
+    def _matches(self, fields: dict, exclude_id: int = None):
+        exact_ids = self._exact.get(self._exact_key(fields), set())
+        matches = {card_id: (1.0, True) for card_id in exact_ids if card_id != exclude_id}
+
+        block_keys = self._block_keys(fields)
+        shared = Counter()
+        for key in block_keys:
+            shared.update(self._blocks.get(key, ()))
+        min_shared = max(1, int(len(block_keys) * MIN_SHARED_NGRAMS))
+
+        for card_id, count in shared.items():
+            if card_id == exclude_id or card_id in matches or count < min_shared:
+                continue
+            score = self._score(fields, self._cards[card_id])
+            if score >= self.threshold:
+                matches[card_id] = (round(score, 3), False)
+        return matches
+
+    def find(self, card, exclude_id: int = None) -> list:
+        """Possible duplicates of `card` as (card_id, score, exact), best first"""
+        matches = self._matches(self._fields(card), exclude_id)
+        return sorted(
+            ((card_id, score, exact) for card_id, (score, exact) in matches.items()),
+            key=lambda m: (-m[1], m[0]),
+        )
+
+    def pairs(self) -> list:
+        """Every pair of possible duplicates in the collection as (id_a, id_b, score, exact)"""
+        result = []
+        for card_id, fields in self._cards.items():
+            for other_id, (score, exact) in self._matches(fields, card_id).items():
+                if other_id > card_id:
+                    result.append((card_id, other_id, score, exact))
+        return sorted(result, key=lambda p: (-p[2], p[0], p[1]))
+
+
+# Per-user indexes kept between requests so the createCard check doesn't rescan.
+# Writes handled by this worker update the index in place. Before reuse an index is
+# checked against the user's card count and max id, which catches cards added or
+# deleted by other workers. Edits made elsewhere don't change those, so an index
+# older than INDEX_TTL_SECONDS is reloaded in the background while the current one
+# keeps answering.
+INDEX_TTL_SECONDS = 60
+MAX_CACHED_INDEXES = 256
+
+
+class _CachedIndex:
+    def __init__(self, index: DuplicateIndex, version: tuple):
+        self.index = index
+        self.version = version
+        self.loaded_at = time.monotonic()
+        # Bumped on every in-place change, a background reload started before one is dropped
+        self.generation = 0
+        self.refreshing = False
+
+
+# _lock only guards the cache dict and is never held while searching or loading.
+# Per-user work runs under a striped lock: a fixed set that is never replaced, so
+# two threads can't end up holding different locks for the same user.
+_indexes = OrderedDict()
+_lock = threading.Lock()
+_user_locks = [threading.Lock() for _ in range(64)]
+
+
+def _user_lock(user_id: int) -> threading.Lock:
+    return _user_locks[hash(user_id) % len(_user_locks)]
+
+
+def _collection_version(db, user_id: int) -> tuple:
+    count, max_id = db.query(func.count(DBCard.id), func.max(DBCard.id)).filter(
+        DBCard.user_id == user_id
+    ).one()
+    return (count, max_id)
+
+
+def _load_index(db, user_id: int) -> DuplicateIndex:
+    index = DuplicateIndex()
+    rows = db.query(
+        DBCard.id, DBCard.playerName, DBCard.year, DBCard.brand, DBCard.setName, DBCard.cardNumber
+    ).filter(DBCard.user_id == user_id).all()
+    for row in rows:
+        index.add(row.id, row)
+    return index
+
+
+def _refresh(user_id: int, cached: _CachedIndex):
+    """Reload an expired index on a primary session and swap it in if nothing changed meanwhile"""
+    generation = cached.generation
+    db = database.SessionLocal()
+    try:
+        version = _collection_version(db, user_id)
+        index = _load_index(db, user_id)
+    except Exception as e:
+        logger.error(f"Error refreshing duplicate index for user {user_id}: {e}")
+        cached.refreshing = False
+        return
+    finally:
+        db.close()
+
+    with _user_lock(user_id):
+        with _lock:
+            if _indexes.get(user_id) is cached and cached.generation == generation:
+                _indexes[user_id] = _CachedIndex(index, version)
+        cached.refreshing = False
+
+
+def _get_index(db, user_id: int) -> DuplicateIndex:
+    """
+    Return the user's index, building it when missing or out of step with the
+    database. Call with the user's lock held. `db` must be a primary session, a
+    lagging replica would get cached.
+    """
+    version = _collection_version(db, user_id)
+    with _lock:
+        cached = _indexes.get(user_id)
+        if cached is not None and cached.version == version:
+            _indexes.move_to_end(user_id)
+            if time.monotonic() - cached.loaded_at >= INDEX_TTL_SECONDS and not cached.refreshing:
+                cached.refreshing = True
+                threading.Thread(target=_refresh, args=(user_id, cached), daemon=True).start()
+            return cached.index
+
+    index = _load_index(db, user_id)
+    with _lock:
+        _indexes[user_id] = _CachedIndex(index, version)
+        _indexes.move_to_end(user_id)
+        while len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def find_duplicates(db, user_id: int, card, exclude_id: int = None) -> list:
+    """Possible duplicates of `card` in the user's collection"""
+    with _user_lock(user_id):
+        return _get_index(db, user_id).find(card, exclude_id)
+
+
+def duplicate_report(db, user_id: int) -> tuple:
+    """(number of cards, all possible duplicate pairs) for the user's collection"""
+    with _user_lock(user_id):
+        index = _get_index(db, user_id)
+        return len(index), index.pairs()
+
+
+def _update_cached(user_id: int, change):
+    """Apply `change(index)` to the user's cached index, if there is one"""
+    with _user_lock(user_id):
+        with _lock:
+            cached = _indexes.get(user_id)
+        if cached is None:
+            return
+        change(cached.index)
+        cached.version = cached.index.version()
+        cached.generation += 1
+
+
+def card_added(user_id: int, card):
+    """Keep a cached index in step with a newly created card"""
+    _update_cached(user_id, lambda index: index.add(card.id, card))
+
+
+def card_updated(previous_user_id: int, card):
+    """Keep cached indexes in step with an edited (possibly reassigned) card"""
+    if previous_user_id != card.user_id:
+        card_removed(previous_user_id, card.id)
+    _update_cached(card.user_id, lambda index: index.add(card.id, card))
+
+
+def card_removed(user_id: int, card_id: int):
+    """Keep a cached index in step with a deleted card"""
+    _update_cached(user_id, lambda index: index.remove(card_id))
+
+
+def invalidate(*user_ids: int):
+    """Drop cached indexes, they are rebuilt on next use"""
+    for user_id in user_ids:
+        with _user_lock(user_id):
+            with _lock:
+                _indexes.pop(user_id, None)
@@ -0,0 +1,184 @@
+"""
+Token-bucket rate limiting and concurrency caps for API routes
+"""
+
+import math
+import threading
+import time
+import logging
+
+from fastapi import HTTPException, Request
+
+from app import config
+
+logger = logging.getLogger(__name__)
+
+
+class InMemoryBackend:
+    """Token buckets kept in process memory (one API worker)"""
+
+    # How often buckets that have refilled to full are dropped
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key: str, rate: float, burst: int):
+        """Take one token from the bucket. Returns (allowed, retry_after_seconds)"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep >= self.SWEEP_INTERVAL:
+                self.sweep(now)
+            tokens, last, _, _ = self._buckets.get(key, (float(burst), now, rate, burst))
+            tokens = min(float(burst), tokens + (now - last) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now, rate, burst)
+                return True, 0.0
+            self._buckets[key] = (tokens, now, rate, burst)
+            return False, (1 - tokens) / rate
+
+    def sweep(self, now: float = None):
+        """
+        Drop buckets that have refilled to full. A missing bucket starts full, so this
+        changes no decision but stops the dict growing with every client ever seen.
+        Callers of take() already hold the lock.
+        """
+        now = time.monotonic() if now is None else now
+        full = [
+            key for key, (tokens, last, rate, burst) in self._buckets.items()
+            if tokens + (now - last) * rate >= burst
+        ]
+        for key in full:
+            del self._buckets[key]
+        self._last_sweep = now
+
+
+class RedisBackend:
+    """Token buckets shared between API workers through Redis"""
+
+    # Refill and take atomically on the Redis side
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url: str):
+        # Optional dependency, only needed when a shared backend is configured
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def take(self, key: str, rate: float, burst: int):
+        allowed, tokens = self._script(
+            keys=[f"ratelimit:{key}"], args=[rate, burst, time.time()]
+        )
+        if int(allowed):
+            return True, 0.0
+        return False, (1 - float(tokens)) / rate
+
+
+def create_backend():
+    """Pick the shared backend if configured, otherwise keep buckets in memory"""
+    if config.RATE_LIMIT_REDIS_URL:
+        try:
+            backend = RedisBackend(config.RATE_LIMIT_REDIS_URL)
+            logger.info("Using Redis rate limit backend")
+            return backend
+        except Exception as e:
+            logger.error(f"Error setting up Redis rate limit backend, falling back to memory: {e}")
+    return InMemoryBackend()
+
+
+backend = create_backend()
+
+
+def client_key(request: Request) -> str:
+    """
+    Identify the caller. Requests carry no auth token yet, so the client IP is the
+    identity; a user id in the path names the target, not the caller, and would let
+    one client spread load across many buckets.
+    """
+    host = request.client.host if request.client else "unknown"
+    return f"ip:{host}"
+
+
+def route_key(request: Request) -> str:
+    """Route template (e.g. /cards/{card_id}) so every id shares one bucket"""
+    route = request.scope.get("route")
+    path = getattr(route, "path", request.url.path)
+    return f"{request.method}:{path}"
+
+
+def rate_limit(rate: float, burst: int, name: str):
+    """
+    Dependency that rejects a client with 429 once its bucket for this route is empty.
+    `name` namespaces the buckets so limiters stacked on one route (the app-wide
+    default plus a stricter one) each keep their own bucket.
+    """
+    def dependency(request: Request):
+        if not config.RATE_LIMIT_ENABLED:
+            return
+        key = f"{name}:{client_key(request)}:{route_key(request)}"
+        try:
+            allowed, retry_after = backend.take(key, rate, burst)
+        except Exception as e:
+            # Never take the API down because the limiter backend is unavailable
+            logger.error(f"Rate limit backend error: {e}")
+            return
+        if not allowed:
+            logger.warning(f"Rate limit exceeded for {key}")
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+
+    return dependency
+
+
+def concurrency_limit(limit: int, retry_after: int = 1):
+    """
+    Dependency that caps how many requests run this route at once (all clients).
+    Requests over the cap are rejected with 429 instead of queueing on the DB pool.
+    """
+    semaphore = threading.BoundedSemaphore(limit)
+
+    def dependency():
+        if not config.RATE_LIMIT_ENABLED:
+            yield
+            return
+        if not semaphore.acquire(blocking=False):
+            raise HTTPException(
+                status_code=429,
+                detail="Server busy, try again shortly",
+                headers={"Retry-After": str(retry_after)},
+            )
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    return dependency
+
+
+# Applied to every route, expensive routes add stricter limits on top
+default_rate_limit = rate_limit(config.RATE_LIMIT_DEFAULT_RATE, config.RATE_LIMIT_DEFAULT_BURST, "default")
@@ -129,6 +129,31 @@ def add_missing_columns():
         logger.error(f"Error during migration: {e}")
         raise
 
+def add_missing_indexes():
+    """Add indexes the models declare but older tables were created without"""
+    try:
+        with engine.connect() as connection:
+            # Check if the cards.user_id index exists (per-user card lookups)
+            result = connection.execute(text("""
+                SELECT indexname FROM pg_indexes 
+                WHERE tablename = 'cards' AND indexname = 'ix_cards_user_id'
+            """))
+            
+            if not result.fetchone():
+                logger.info("Adding ix_cards_user_id index...")
+                connection.execute(text("""
+                    CREATE INDEX ix_cards_user_id ON cards (user_id)
+                """))
+                logger.info("✅ ix_cards_user_id index added")
+            else:
+                logger.info("ix_cards_user_id index already exists")
+            
+            connection.commit()
+            
+    except Exception as e:
+        logger.error(f"Error adding indexes: {e}")
+        raise
+
 def update_existing_cards():
     """Update existing cards to have a default user_id if they don't have one"""
     try:
@@ -178,6 +203,9 @@ def main():
         # Add missing columns
         add_missing_columns()
         
+        # Add missing indexes
+        add_missing_indexes()
+        
         # Update existing cards
         update_existing_cards()
         
@@ -11,7 +11,7 @@ from app.database import engine, SessionLocal
 from app.models.user import User
 from app.models.card import Card
 from app.auth.auth import hash_password
-from sqlalchemy import text
+from sqlalchemy import text, event
 
 def test_database_connection():
     """Test if we can connect to the database"""
@@ -84,10 +84,430 @@ def test_create_card(user_id):
     finally:
         db.close()
 
+def count_statements(func):
+    """Run func and return how many SQL statements it issued"""
+    statements = []
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(engine, "before_cursor_execute", before_execute)
+    try:
+        func()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_execute)
+    return len(statements)
+
+def test_eager_loading(user_id):
+    """Check card+owner and user+cards responses use a fixed number of statements"""
+    from app.main import getCards, get_user
+    try:
+        db = SessionLocal()
+        
+        # Add a second card so per-row lazy loads would show up as extra statements
+        test_create_card(user_id)
+        
+        cards_statements = count_statements(lambda: getCards(include="owner", db=db))
+        db.expunge_all()
+        user_statements = count_statements(lambda: get_user(user_id, include="cards", limit=None, db=db))
+        db.expunge_all()
+        responses = []
+        plain_statements = count_statements(lambda: responses.append(get_user(user_id, include=None, limit=None, db=db)))
+        
+        if responses[0].cards is not None:
+            print("❌ User without include=cards returned cards")
+            return False
+        if cards_statements == 1 and user_statements == 2 and plain_statements == 1:
+            print(f"✅ Eager loading OK: cards+owner {cards_statements}, user+cards {user_statements}, user {plain_statements} statements")
+            return True
+        print(f"❌ Unexpected statement counts: cards+owner {cards_statements}, user+cards {user_statements}, user {plain_statements}")
+        return False
+        
+    except Exception as e:
+        print(f"❌ Error testing eager loading: {e}")
+        return False
+    finally:
+        db.close()
+
+def _fake_request(method, path, host="10.0.0.1", headers=None):
+    """Minimal request for calling route dependencies outside the app"""
+    from types import SimpleNamespace
+    from fastapi import Request
+    return Request({
+        "type": "http",
+        "method": method,
+        "path": path,
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        "client": (host, 12345),
+        "path_params": {},
+        "route": SimpleNamespace(path=path),
+    })
+
+def test_rate_limit_buckets():
+    """Check stacked limiters keep separate buckets with their own burst and refill"""
+    import time
+    from fastapi import HTTPException
+    from app.utils import rate_limit as rl
+    
+    def admitted(limiter, request):
+        try:
+            limiter(request)
+            return True
+        except HTTPException as e:
+            return e
+    
+    try:
+        rl.backend = rl.InMemoryBackend()
+        request = _fake_request("POST", "/users/login")
+        default = rl.rate_limit(100, 20, "default")
+        strict = rl.rate_limit(2, 3, "login")
+        
+        # Both limiters on every request, like the app-wide default plus a route limit
+        results = []
+        for _ in range(5):
+            results.append(admitted(default, request) is True and admitted(strict, request))
+        if results[:3] != [True] * 3 or any(r is True for r in results[3:]):
+            print(f"❌ Strict burst of 3 not honoured: {results}")
+            return False
+        retry_after = int(results[3].headers["Retry-After"])
+        if retry_after != 1 or admitted(default, request) is not True:
+            print(f"❌ Default bucket should be untouched, Retry-After {retry_after}")
+            return False
+        
+        # Slow login bucket reports its own refill time
+        slow = rl.rate_limit(0.2, 1, "slow_login")
+        admitted(slow, request)
+        blocked = admitted(slow, request)
+        if blocked is True or int(blocked.headers["Retry-After"]) != 5:
+            print("❌ Retry-After should follow the limiter's own rate (5s)")
+            return False
+        
+        # Strict bucket refills at 2/s on its own
+        time.sleep(0.6)
+        if admitted(strict, request) is not True:
+            print("❌ Strict bucket did not refill")
+            return False
+        
+        # Full buckets are swept so the store doesn't grow per client
+        for i in range(50):
+            rl.backend.take(f"sweep:{i}", 1000, 1)
+        time.sleep(0.01)
+        with rl.backend._lock:
+            rl.backend.sweep()
+        if any(key.startswith("sweep:") for key in rl.backend._buckets):
+            print("❌ Refilled buckets were not swept")
+            return False
+        
+        print("✅ Rate limit buckets are independent, refill and get swept")
+        return True
+    finally:
+        rl.backend = rl.create_backend()
+
+def test_duplicate_matching():
+    """Check normalization, fuzzy scoring and n-gram blocking of the duplicate index"""
+    from types import SimpleNamespace
+    from app.utils.duplicates import DuplicateIndex, normalize_card_number, SIMILARITY_THRESHOLD
+    
+    def card(playerName, cardNumber, year=2020, brand="Panini", setName="Prizm"):
+        return SimpleNamespace(playerName=playerName, year=year, brand=brand, setName=setName, cardNumber=cardNumber)
+    
+    numbers = [normalize_card_number(n) for n in ["#007", "No. 7", "7", "007"]]
+    if numbers != ["7"] * 4:
+        print(f"❌ Card numbers not normalized: {numbers}")
+        return False
+    
+    index = DuplicateIndex()
+    index.add(1, card("Luka Dončić", "#007"))
+    index.add(2, card("Luka Doncic", "77"))
+    index.add(3, card("Michael Jordan", "7"))
+    index.add(4, card("Luka Doncic", "7", year=2021))
+    
+    # Exact after case, accent, punctuation and number normalization
+    exact = index.find(card("  LUKA  doncic!", "No. 7", brand="panini", setName="PRIZM"))
+    if exact[:1] != [(1, 1.0, True)]:
+        print(f"❌ Exact normalized match missing: {exact}")
+        return False
+    
+    # Typo in the name and set still scores above the threshold, not as exact
+    fuzzy = index.find(card("Luka Doncik", "7", setName="Prizm."))
+    fuzzy_scores = {card_id: (score, is_exact) for card_id, score, is_exact in fuzzy}
+    if 1 not in fuzzy_scores or fuzzy_scores[1][1] or fuzzy_scores[1][0] < SIMILARITY_THRESHOLD:
+        print(f"❌ Fuzzy match missing: {fuzzy}")
+        return False
+    
+    # Other player, other card number or other year stay out
+    if 3 in fuzzy_scores or 2 in fuzzy_scores or 4 in fuzzy_scores:
+        print(f"❌ Unrelated cards matched: {fuzzy}")
+        return False
+    
+    # Each pair reported once
+    index.add(5, card("luka doncic", "7"))
+    pairs = index.pairs()
+    keys = [tuple(sorted(p[:2])) for p in pairs]
+    if len(keys) != len(set(keys)) or (1, 5) not in keys or any(p[0] >= p[1] for p in pairs):
+        print(f"❌ Pairs reported more than once: {pairs}")
+        return False
+    
+    print("✅ Duplicate matching OK")
+    return True
+
+def test_duplicate_pairs_large():
+    """Check pairs() on a large collection only scores candidates that can match"""
+    import random
+    import time
+    from types import SimpleNamespace
+    from app.utils.duplicates import DuplicateIndex
+    
+    rng = random.Random(1)
+    first = ["michael", "lebron", "kobe", "luka", "stephen", "kevin", "tim", "shaquille", "magic", "larry"]
+    last = ["jordan", "james", "bryant", "doncic", "curry", "durant", "duncan", "oneal", "johnson", "bird"]
+    index = DuplicateIndex()
+    for card_id in range(20000):
+        index.add(card_id, SimpleNamespace(
+            playerName=f"{rng.choice(first)} {rng.choice(last)}", year=rng.randint(2015, 2020),
+            brand="Panini", setName=rng.choice(["Prizm", "Select", "Optic"]), cardNumber=str(rng.randint(1, 300)),
+        ))
+    
+    scored = []
+    score = index._score
+    index._score = lambda a, b: scored.append(a["cardNumber"] == b["cardNumber"]) or score(a, b)
+    started = time.monotonic()
+    pairs = index.pairs()
+    elapsed = time.monotonic() - started
+    
+    if not all(scored):
+        print(f"❌ {scored.count(False)} of {len(scored)} scorings had a different card number")
+        return False
+    if elapsed > 5:
+        print(f"❌ pairs() on 20000 cards took {elapsed:.1f}s")
+        return False
+    print(f"✅ pairs() on 20000 cards: {len(pairs)} pairs, {len(scored)} scorings in {elapsed:.2f}s")
+    return True
+
+def test_duplicate_cache(user_id):
+    """Check the cached duplicate index notices cards written by another worker"""
+    from app.utils import duplicates
+    try:
+        db = SessionLocal()
+        before, _ = duplicates.duplicate_report(db, user_id)
+        
+        # Written through another session, as another worker would, without card_added
+        card_id = test_create_card(user_id)
+        after, _ = duplicates.duplicate_report(db, user_id)
+        matches = duplicates.find_duplicates(db, user_id, db.get(Card, card_id), exclude_id=card_id)
+        
+        if after != before + 1 or not any(exact for _, _, exact in matches):
+            print(f"❌ Cached index is stale: {before} -> {after} cards, matches {matches}")
+            return False
+        
+        # A long report for one user must not hold up another user's duplicate check
+        import threading
+        other_done = threading.Event()
+        with duplicates._user_lock(user_id):
+            def check_other_user():
+                other_db = SessionLocal()
+                try:
+                    duplicates.find_duplicates(other_db, user_id + 1, db.get(Card, card_id))
+                finally:
+                    other_db.close()
+                    other_done.set()
+            threading.Thread(target=check_other_user).start()
+            if not other_done.wait(5):
+                print("❌ Another user's duplicate check waited on this user's lock")
+                return False
+        # Edits elsewhere keep count and max id, the expired index is reloaded in the background
+        import time
+        saved_ttl, saved_load = duplicates.INDEX_TTL_SECONDS, duplicates._load_index
+        loads_on_request = []
+        def load_index(load_db, load_user_id):
+            loads_on_request.append(threading.current_thread() is threading.main_thread())
+            return saved_load(load_db, load_user_id)
+        try:
+            duplicates.INDEX_TTL_SECONDS = 0
+            duplicates._load_index = load_index
+            other = SessionLocal()
+            other.get(Card, card_id).cardNumber = "999"
+            other.commit()
+            other.close()
+            
+            edited = db.get(Card, card_id)
+            db.refresh(edited)
+            for _ in range(50):
+                if duplicates.find_duplicates(db, user_id, edited, exclude_id=card_id) == []:
+                    break
+                time.sleep(0.1)
+            else:
+                print("❌ Expired index was never refreshed after an outside edit")
+                return False
+            if any(loads_on_request):
+                print("❌ Expired index was reloaded on the request thread")
+                return False
+        finally:
+            duplicates.INDEX_TTL_SECONDS, duplicates._load_index = saved_ttl, saved_load
+        
+        # Deletes handled here update the index in place, without a reload
+        db.delete(db.get(Card, card_id))
+        db.commit()
+        duplicates.card_removed(user_id, card_id)
+        reloads = []
+        duplicates._load_index = lambda *args: reloads.append(args) or saved_load(*args)
+        try:
+            count, _ = duplicates.duplicate_report(db, user_id)
+        finally:
+            duplicates._load_index = saved_load
+        if count != after - 1 or reloads:
+            print(f"❌ In-place removal not applied: {count} cards, {len(reloads)} reloads")
+            return False
+        
+        print("✅ Duplicate index cache refreshes on outside writes")
+        return True
+    except Exception as e:
+        print(f"❌ Error testing duplicate cache: {e}")
+        return False
+    finally:
+        db.close()
+
+def test_replica_routing():
+    """Check read routing with SQLite files standing in for the primary and two replicas"""
+    import tempfile
+    import time
+    from sqlalchemy.orm import sessionmaker
+    from app import database
+    
+    def routed_to(request):
+        sessions = database.get_read_db(request)
+        db = next(sessions)
+        try:
+            return os.path.basename(db.get_bind().url.database)
+        finally:
+            sessions.close()
+    
+    saved = (database.SessionLocal, database.READ_YOUR_WRITES_SECONDS)
+    saved_write_log = database._write_log
+    with tempfile.TemporaryDirectory() as tmp:
+        urls = {name: f"sqlite:///{os.path.join(tmp, name)}" for name in ["primary.db", "replica1.db", "replica2.db"]}
+        primary_engine = None
+        try:
+            primary_engine = database._create_engine(urls["primary.db"])
+            database.SessionLocal = sessionmaker(bind=primary_engine)
+            database.configure_replicas([urls["replica1.db"], urls["replica2.db"]])
+            database.READ_YOUR_WRITES_SECONDS = 0.3
+            
+            reader = _fake_request("GET", "/cards", host="10.0.0.2")
+            other = _fake_request("GET", "/cards", host="10.0.0.3")
+            
+            # Round robin between the replicas
+            rotation = [routed_to(reader) for _ in range(4)]
+            if rotation not in (["replica1.db", "replica2.db"] * 2, ["replica2.db", "replica1.db"] * 2):
+                print(f"❌ Replicas not used round robin: {rotation}")
+                return False
+            
+            # A client that just wrote reads from the primary, others keep using replicas
+            database.mark_write(_fake_request("POST", "/cards", host="10.0.0.2"))
+            if routed_to(reader) != "primary.db" or routed_to(other) == "primary.db":
+                print("❌ Reads after a write did not stay on the primary for the writer only")
+                return False
+            
+            # Writes by user id pin that user's reads through the X-User-Id header
+            database.mark_write(_fake_request("POST", "/cards", host="10.0.0.9"), user_id=7)
+            if routed_to(_fake_request("GET", "/cards", host="10.0.0.4", headers={"X-User-Id": "7"})) != "primary.db":
+                print("❌ User's reads after a write did not go to the primary")
+                return False
+            
+            # Once the window passes, reads go back to the replicas
+            time.sleep(0.4)
+            if routed_to(reader) == "primary.db":
+                print("❌ Reads stayed on the primary after the window")
+                return False
+            
+            # With a shared store a write seen by one worker pins reads on every worker
+            class SharedStore:
+                def __init__(self):
+                    self.keys = {}
+                def pipeline(self):
+                    return self
+                def set(self, key, value, px):
+                    self.keys[key] = time.monotonic() + px / 1000
+                def execute(self):
+                    pass
+                def exists(self, *keys):
+                    return sum(1 for key in keys if self.keys.get(key, 0) > time.monotonic())
+            database._write_log = SharedStore()
+            database.mark_write(_fake_request("POST", "/cards", host="10.0.0.5"))
+            database._recent_writes.clear()  # another worker never saw the write itself
+            if routed_to(_fake_request("GET", "/cards", host="10.0.0.5")) != "primary.db":
+                print("❌ Write recorded in the shared store was not seen by other workers")
+                return False
+            database._write_log = saved_write_log
+            
+            # An unreachable replica is skipped instead of failing the read
+            database.configure_replicas([f"sqlite:///{os.path.join(tmp, 'missing', 'replica.db')}", urls["replica2.db"]])
+            fallback = {routed_to(other) for _ in range(4)}
+            database.configure_replicas([f"sqlite:///{os.path.join(tmp, 'missing', 'replica.db')}"])
+            only_dead = routed_to(other)
+            if fallback != {"replica2.db"} or only_dead != "primary.db":
+                print(f"❌ Unreachable replica not skipped: {fallback}, {only_dead}")
+                return False
+            
+            print("✅ Replica routing OK: round robin, read-your-writes window, shared store, dead replica fallback")
+            return True
+        finally:
+            database.SessionLocal, database.READ_YOUR_WRITES_SECONDS = saved
+            database._write_log = saved_write_log
+            for test_engine in database.replica_engines + [primary_engine]:
+                if test_engine is not None:
+                    test_engine.dispose()
+            database.configure_replicas(database.SQLALCHEMY_REPLICA_URLS)
+
+def test_create_card_unknown_user():
+    """Check a card for a missing user is a 404 and leaves no image files behind"""
+    from fastapi import HTTPException
+    from app.main import createCard
+    from app.schemas import Card as CardSchema
+    try:
+        db = SessionLocal()
+        missing_user_id = (db.query(User.id).order_by(User.id.desc()).limit(1).scalar() or 0) + 1000
+        images_before = set(os.listdir("static/images"))
+        card = CardSchema(
+            user_id=missing_user_id, playerName="Nobody", year=2023, brand="Test Brand",
+            setName="Test Set", sport="Baseball", cardNumber="1", condition="Mint",
+            front_image_url="data:image/jpeg;base64,/9j/4AAQSkZJRg==",
+        )
+        try:
+            createCard(card, _fake_request("POST", "/cards"), db=db)
+            print("❌ Card created for a missing user")
+            return False
+        except HTTPException as e:
+            if e.status_code != 404:
+                print(f"❌ Expected 404 for a missing user, got {e.status_code}: {e.detail}")
+                return False
+        if set(os.listdir("static/images")) != images_before:
+            print("❌ Image files left behind after a failed insert")
+            return False
+        print("✅ Card for a missing user rejected by the foreign key, no files left behind")
+        return True
+    except Exception as e:
+        print(f"❌ Error testing missing user: {e}")
+        return False
+    finally:
+        db.close()
+
 def main():
     print("🧪 Testing Sports Card Database...")
     print("=" * 50)
     
+    # Checks that don't need the database
+    if not test_rate_limit_buckets():
+        print("❌ Rate limit check failed")
+        return
+    if not test_duplicate_matching():
+        print("❌ Duplicate matching check failed")
+        return
+    if not test_duplicate_pairs_large():
+        print("❌ Large duplicate report check failed")
+        return
+    if not test_replica_routing():
+        print("❌ Replica routing check failed")
+        return
+    
     # Test database connection
     if not test_database_connection():
         print("❌ Cannot proceed without database connection")
@@ -105,6 +525,21 @@ def main():
         print("❌ Card creation failed")
         return
     
+    # Test duplicate index cache
+    if not test_duplicate_cache(user_id):
+        print("❌ Duplicate cache check failed")
+        return
+    
+    # Test the foreign key check on card creation
+    if not test_create_card_unknown_user():
+        print("❌ Missing user check failed")
+        return
+    
+    # Test N+1-free responses
+    if not test_eager_loading(user_id):
+        print("❌ Eager loading check failed")
+        return
+    
     print("=" * 50)
     print("🎉 All tests passed! Your database is working correctly.")
     print(f"Test user ID: {user_id}")